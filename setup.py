@@ -46,7 +46,9 @@ if Changelog is None:
     __version__ = 'dev'
 else:
     with open('debian/changelog', encoding='utf-8') as infp:
-        __version__ = str(Changelog(infp).version)
+        # Only the topmost entry is needed for the version, so don't bother
+        # parsing the entire history.
+        __version__ = str(Changelog(infp, max_blocks=1).version)
         # Write the version out to the package directory so `ubuntu-image
         # --version` can display it.
         with open('ubuntu_image/version.txt', 'w', encoding='utf-8') as outfp:
@@ -5,6 +5,7 @@ import re
 import shutil
 import logging
 
+from glob import glob
 from subprocess import CalledProcessError
 from tempfile import gettempdir
 from ubuntu_image.common_builder import AbstractImageBuilderState
@@ -85,7 +86,7 @@ class ClassicBuilder(AbstractImageBuilderState):
             src = self.args.filesystem
             # 'cp -a' is faster than the python functions and makes sure all
             # meta information is preserved.
-            run('cp -a {} {}'.format(os.path.join(src, '*'), dst), shell=True)
+            run(['cp', '-a'] + sorted(glob(os.path.join(src, '*'))) + [dst])
         else:
             src = os.path.join(self.unpackdir, 'chroot')
             for subdir in os.listdir(src):
@@ -128,15 +129,18 @@ class ClassicBuilder(AbstractImageBuilderState):
         # only useful in a live CD/DVD are removed.
         # The deprecated words can be found below:
         # https://help.ubuntu.com/community/MakeALiveCD/DVD/BootableFlashFromHarddiskInstall
-        deprecated_words = ['ubiquity', 'casper']
+        #
+        # The lines are only filtered and copied, never interpreted, so work
+        # on bytes and skip decoding and re-encoding every one of them.
+        deprecated_words = [b'ubiquity', b'casper']
         manifest_path = os.path.join(self.output_dir, 'filesystem.manifest')
         tmpfile_path = os.path.join(gettempdir(), 'filesystem.manifest')
-        with open(tmpfile_path, 'w+') as tmpfile:
+        with open(tmpfile_path, 'wb+') as tmpfile:
             query_cmd = ['sudo', 'chroot', self.rootfs, 'dpkg-query', '-W',
                          '--showformat=${Package} ${Version}\n']
             run(query_cmd, stdout=tmpfile, stderr=None, env=os.environ)
             tmpfile.seek(0, 0)
-            with open(manifest_path, 'w') as manifest:
+            with open(manifest_path, 'wb') as manifest:
                 for line in tmpfile:
                     if not any(word in line for word in deprecated_words):
                         manifest.write(line)
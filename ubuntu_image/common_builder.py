@@ -4,9 +4,9 @@ import os
 import shutil
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
 from pathlib import Path
-from subprocess import CalledProcessError
 from tempfile import TemporaryDirectory
 from ubuntu_image.helpers import (
      DoesNotFit, MiB, mkfs_ext4, run, unsparse_swapfile_ext4)
@@ -18,7 +18,6 @@ from ubuntu_image.parser import (
 from ubuntu_image.state import State
 
 
-SPACE = ' '
 _logger = logging.getLogger('ubuntu-image')
 
 
@@ -37,6 +36,7 @@ class AbstractImageBuilderState(State):
         # which is where `lb config && lb build` will put its contents.
         # It will contain a root/ directory which containing everything needed
         # for the final root file system.
+        # Set $TMPDIR to a tmpfs to put the temporary working directory there.
         self.workdir = (
             self.resources.enter_context(TemporaryDirectory())
             if args.workdir is None
@@ -63,6 +63,8 @@ class AbstractImageBuilderState(State):
         self.disable_console_conf = args.disable_console_conf
         self.exitcode = 0
         self.done = False
+        # Directories known to exist in the volume and rootfs trees.
+        self._created_dirs = set()
         # Generic hook handling manager.
         self.hookdirs = args.hooks_directory
         self.hook_manager = HookManager(self.hookdirs)
@@ -108,6 +110,9 @@ class AbstractImageBuilderState(State):
         self.unpackdir = state['unpackdir']
         self.volumedir = state['volumedir']
         self.hookdirs = state['hookdirs']
+        # The directory cache isn't saved; the trees may have been changed
+        # between the runs.
+        self._created_dirs = set()
         # Restore the hook manager along with the state.
         self.hook_manager = HookManager(self.hookdirs)
 
@@ -179,11 +184,33 @@ class AbstractImageBuilderState(State):
 
     @staticmethod
     def _calculate_dirsize(path):
-        # more accruate way to calculate size of dir which
-        # contains hard or soft links
-        total = 0
-        proc = run('du -s -B1 {}'.format(path))
-        total = int(proc.stdout.strip().split()[0])
+        # Calculate the disk usage of the tree the same way `du -s -B1` does,
+        # i.e. count allocated blocks and count hard linked inodes only once,
+        # but without forking.  os.scandir() gives us the file type for free,
+        # so each entry costs a single lstat().
+        info = os.lstat(path)
+        total = info.st_blocks * 512
+        seen = set()
+        dirs = [path]
+        while dirs:
+            entries = os.scandir(dirs.pop())
+            try:
+                for entry in entries:
+                    info = entry.stat(follow_symlinks=False)
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif info.st_nlink > 1:
+                        inode = (info.st_dev, info.st_ino)
+                        if inode in seen:
+                            continue
+                        seen.add(inode)
+                    total += info.st_blocks * 512
+            finally:
+                # Don't leak the directory's file descriptor if stat() fails.
+                # Python 3.5's iterator has no close(); there it's released
+                # when the iterator gets garbage collected.
+                if hasattr(entries, 'close'):           # pragma: no branch
+                    entries.close()                     # pragma: noxenial
         # Fudge factor for incidentals.
         total *= 1.5
         return ceil(total)
@@ -191,11 +218,18 @@ class AbstractImageBuilderState(State):
     def calculate_rootfs_size(self):
         # Calculate the size of the root file system.
         #
+        # We can't keep a running tally while populating the rootfs, since
+        # its contents are moved in wholesale from `snap prepare-image` or
+        # live-build output, and the post-populate-rootfs hooks are free to
+        # add or remove anything.  So this has to be a walk of the final tree.
+        #
         # On a 100MiB filesystem, ext4 takes a little over 7MiB for the
         # metadata.  Use 8MiB as a minimum padding here.
         try:
             self.rootfs_size = self._calculate_dirsize(self.rootfs) + MiB(8)
-        except CalledProcessError:
+        except OSError as error:
+            _logger.error('Unable to calculate the rootfs size: {}'.format(
+                error))
             if self.args.debug:
                 _logger.exception('Full debug traceback follows')
             self.exitcode = 1
@@ -203,12 +237,22 @@ class AbstractImageBuilderState(State):
         else:
             self._next.append(self.pre_populate_bootfs_contents)
 
+    def _ensure_dir(self, path):
+        # Like os.makedirs(path, exist_ok=True), but remember the directories
+        # we've already made, along with all their parents, so that many
+        # files sharing a target directory only stat its path once.
+        if path in self._created_dirs:
+            return
+        os.makedirs(path, exist_ok=True)
+        self._created_dirs.add(path)
+        self._created_dirs.update(str(parent) for parent in Path(path).parents)
+
     def pre_populate_bootfs_contents(self):
         for name, volume in self.gadget.volumes.items():
             for partnum, part in enumerate(volume.structures):
                 target_dir = os.path.join(
                     volume.basedir, 'part{}'.format(partnum))
-                os.makedirs(target_dir, exist_ok=True)
+                self._ensure_dir(target_dir)
         self._next.append(self.populate_bootfs_contents)
 
     @classmethod
@@ -272,7 +316,7 @@ class AbstractImageBuilderState(State):
                         'Unsupported volume bootloader value: {}'.format(
                             volume.bootloader))
                 if os.path.isdir(boot):
-                    os.makedirs(ubuntu, exist_ok=True)
+                    self._ensure_dir(ubuntu)
                     for filename in os.listdir(boot):
                         src = os.path.join(boot, filename)
                         dst = os.path.join(ubuntu, filename)
@@ -325,11 +369,11 @@ class AbstractImageBuilderState(State):
                             # slash necessary at least to handle the case of
                             # recursive copy into the root directory), so make
                             # sure here that it exists.
-                            os.makedirs(dst, exist_ok=True)
+                            self._ensure_dir(dst)
+                            target_path = os.path.join(target_dir, target)
                             for filename in os.listdir(src):
                                 sub_src = os.path.join(src, filename)
-                                dst = os.path.join(
-                                    target_dir, target, filename)
+                                dst = os.path.join(target_path, filename)
                                 if os.path.isdir(sub_src):
                                     self._selective_copytree(sub_src, dst)
                                 else:
@@ -339,7 +383,7 @@ class AbstractImageBuilderState(State):
                             # XXX: If this is a directory instead of a
                             # file, give a useful error message
                             # instead of a traceback.
-                            os.makedirs(os.path.dirname(dst), exist_ok=True)
+                            self._ensure_dir(os.path.dirname(dst))
                             if not os.path.exists(dst):
                                 shutil.copy(src, dst)
 
@@ -370,27 +414,28 @@ class AbstractImageBuilderState(State):
                 continue
             part_img = os.path.join(
                 volume.basedir, 'part{}.img'.format(partnum))
-            # Create the actual image files now.
-            if part.role is StructureRole.system_data:
-                # The image for the root partition.
-                # We defer creating the root file system image because we have
-                # to populate it at the same time.  See mkfs.ext4(8) for
-                # details.
-                Path(part_img).touch()
-                os.truncate(part_img, part.size)
-            else:
-                run('dd if=/dev/zero of={} count=0 bs={} seek=1'.format(
-                    part_img, part.size))
-                if part.filesystem is FileSystemType.vfat:
-                    label_option = (
-                        '-n {}'.format(part.filesystem_label)
-                        # TODO: I think this could be None or the empty string,
-                        # but this needs verification.
-                        if part.filesystem_label
-                        else '')
-                    # TODO: hard-coding of sector size.
-                    run('mkfs.vfat -s 1 -S 512 -F 32 {} {}'.format(
-                        label_option, part_img))
+            # Create the actual image files now, as sparse files of the
+            # structure's size.  This is what `dd count=0 seek=1` would do,
+            # but without the fork.  Don't preallocate them with
+            # posix_fallocate(): mke2fs punches holes into (discards) its
+            # whole target file anyway, and the holes are what lets the
+            # sparse copy into the disk image skip unused blocks.
+            Path(part_img).touch()
+            os.truncate(part_img, part.size)
+            # The image for the root partition is left empty.  We defer
+            # creating the root file system image because we have to populate
+            # it at the same time.  See mkfs.ext4(8) for details.
+            if (part.role is not StructureRole.system_data and
+                    part.filesystem is FileSystemType.vfat):
+                label_option = (
+                    '-n {}'.format(part.filesystem_label)
+                    # TODO: I think this could be None or the empty string,
+                    # but this needs verification.
+                    if part.filesystem_label
+                    else '')
+                # TODO: hard-coding of sector size.
+                run('mkfs.vfat -s 1 -S 512 -F 32 {} {}'.format(
+                    label_option, part_img))
             volume.part_images.append(part_img)
         # Calculate or check the final image size.
         #
@@ -454,75 +499,105 @@ class AbstractImageBuilderState(State):
                 self.unpackdir, 'gadget')
             if os.path.isdir(boot):
                 os.makedirs(gadget, exist_ok=True)
+                # Like the grub and u-boot bits, these are only needed in
+                # their new location, so move instead of copying them.  When
+                # both directories are on the same file system (they normally
+                # are, both being in the unpack directory) this is a rename.
                 for filename in os.listdir(boot):
                     src = os.path.join(boot, filename)
                     dst = os.path.join(gadget, filename)
-                    shutil.copy(src, dst)
-        for partnum, part in enumerate(volume.structures):
-            if self._should_skip_partition(part):
-                continue
-            part_img = volume.part_images[partnum]
-            # In seeded images, the system-seed partition is basically the
-            # rootfs partition - at least from the ubuntu-image POV.
-            if part.role is StructureRole.system_seed:
-                part_dir = self.rootfs
-            else:
-                part_dir = os.path.join(volume.basedir,
-                                        'part{}'.format(partnum))
-            if part.role is StructureRole.system_data:
-                # The root partition needs to be ext4, which may or may not be
-                # populated at creation time, depending on the version of
-                # e2fsprogs.
-                mkfs_ext4(part_img, self.rootfs, self.args.cmd,
-                          part.filesystem_label, preserve_ownership=True)
-                # XXX: This is a workaround for mkfs.ext4 sparsifying our
-                # classic rootfses swapfile.
-                if self.args.cmd == 'classic':
-                    unsparse_swapfile_ext4(part_img)
-            elif part.filesystem is FileSystemType.none:
-                image = Image(part_img, part.size)
-                offset = 0
-                for content in part.content:
-                    src = os.path.join(self.unpackdir, 'gadget', content.image)
-                    file_size = os.path.getsize(src)
-                    assert content.size is None or content.size >= file_size, (
-                        'Spec size {} < actual size {} of: {}'.format(
-                            content.size, file_size, content.image))
-                    if content.size is not None:
-                        file_size = content.size
-                    # TODO: We need to check for overlapping images.
-                    if content.offset is not None:
-                        offset = content.offset
-                    end = offset + file_size
-                    if end > part.size:
-                        if part.name is None:
-                            if part.role is None:
-                                whats_wrong = part.type
-                            else:
-                                whats_wrong = part.role.value
+                    shutil.move(src, dst)
+        # Every structure has its own image file, and populating them is
+        # mostly waiting on mkfs.ext4, mcopy and dd, so do them concurrently.
+        # Only a few at a time though.  They all write to the same working
+        # directory, so more would just contend for the disk, and with older
+        # e2fsprogs each ext4 structure is filled in through its own sudo
+        # loop mount.
+        #
+        # Results are collected in structure order, so the first failing
+        # structure is the one whose exception gets raised, but only once the
+        # structures after it have finished too.
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [
+                executor.submit(
+                    self._populate_one_part, name, volume, partnum, part)
+                for partnum, part in enumerate(volume.structures)
+                if not self._should_skip_partition(part)
+                ]
+            for future in futures:
+                future.result()
+
+    def _populate_one_part(self, name, volume, partnum, part):
+        part_img = volume.part_images[partnum]
+        # In seeded images, the system-seed partition is basically the
+        # rootfs partition - at least from the ubuntu-image POV.
+        if part.role is StructureRole.system_seed:
+            part_dir = self.rootfs
+        else:
+            part_dir = os.path.join(volume.basedir, 'part{}'.format(partnum))
+        if part.role is StructureRole.system_data:
+            # The root partition needs to be ext4, which may or may not be
+            # populated at creation time, depending on the version of
+            # e2fsprogs.
+            mkfs_ext4(part_img, self.rootfs, self.args.cmd,
+                      part.filesystem_label, preserve_ownership=True)
+            # XXX: This is a workaround for mkfs.ext4 sparsifying our
+            # classic rootfses swapfile.
+            if self.args.cmd == 'classic':
+                unsparse_swapfile_ext4(part_img)
+        elif part.filesystem is FileSystemType.none:
+            image = Image(part_img, part.size)
+            offset = 0
+            for content in part.content:
+                src = os.path.join(self.unpackdir, 'gadget', content.image)
+                file_size = os.path.getsize(src)
+                assert content.size is None or content.size >= file_size, (
+                    'Spec size {} < actual size {} of: {}'.format(
+                        content.size, file_size, content.image))
+                if content.size is not None:
+                    file_size = content.size
+                # TODO: We need to check for overlapping images.
+                if content.offset is not None:
+                    offset = content.offset
+                end = offset + file_size
+                if end > part.size:
+                    if part.name is None:
+                        if part.role is None:
+                            whats_wrong = part.type
                         else:
-                            whats_wrong = part.name
-                        part_path = 'volumes:<{}>:structure:<{}>'.format(
-                            name, whats_wrong)
-                        self.exitcode = 1
-                        raise DoesNotFit(partnum, part_path, end - part.size)
-                    image.copy_blob(src, bs=1, seek=offset, conv='notrunc')
-                    offset += file_size
-            elif part.filesystem is FileSystemType.vfat:
-                sourcefiles = SPACE.join(
-                    os.path.join(part_dir, filename)
-                    for filename in os.listdir(part_dir)
-                    )
+                            whats_wrong = part.role.value
+                    else:
+                        whats_wrong = part.name
+                    part_path = 'volumes:<{}>:structure:<{}>'.format(
+                        name, whats_wrong)
+                    self.exitcode = 1
+                    raise DoesNotFit(partnum, part_path, end - part.size)
+                image.copy_blob(src, seek=offset)
+                offset += file_size
+        elif part.filesystem is FileSystemType.vfat:
+            # Copy all the contents with a single mcopy call.  Pass the
+            # arguments as a list so that file names don't get split, and
+            # don't bother spawning mcopy when there is nothing to copy
+            # into the freshly created file system.
+            #
+            # This listing can't be taken from the rootfs size calculation,
+            # even when part_dir is the rootfs: the boot assets for seeded
+            # images get copied into it after its size has been calculated.
+            sourcefiles = [
+                os.path.join(part_dir, filename)
+                for filename in sorted(os.listdir(part_dir))
+                ]
+            if sourcefiles:
                 env = dict(MTOOLS_SKIP_CHECK='1')
                 env.update(os.environ)
-                run('mcopy -s -i {} {} ::'.format(part_img, sourcefiles),
+                run(['mcopy', '-s', '-i', part_img] + sourcefiles + ['::'],
                     env=env)
-            elif part.filesystem is FileSystemType.ext4:
-                mkfs_ext4(part_img, part_dir, self.args.cmd,
-                          part.filesystem_label)
-            else:
-                raise AssertionError('Invalid part filesystem type: {}'.format(
-                    part.filesystem))
+        elif part.filesystem is FileSystemType.ext4:
+            mkfs_ext4(part_img, part_dir, self.args.cmd,
+                      part.filesystem_label)
+        else:
+            raise AssertionError('Invalid part filesystem type: {}'.format(
+                part.filesystem))
 
     def populate_filesystems(self):
         for name, volume in self.gadget.volumes.items():
@@ -535,6 +610,7 @@ class AbstractImageBuilderState(State):
         image = Image(imgfile, volume.image_size, volume.schema)
         offset_writes = []
         part_offsets = {}
+        partitioned = False
         # We first create all the needed partitions.
         # For regular core16 and core18 builds, this means creating all of the
         # defined partitions.  For core20 (the so called 'seeded images'), we
@@ -556,7 +632,13 @@ class AbstractImageBuilderState(State):
                     part.role is StructureRole.system_data and
                     part.name is None):
                 part.name = 'writable'
-            image.partition(part.offset, part.size, part.name, activate)
+            image.partition(part.offset, part.size, part.name, activate,
+                            commit=False)
+            partitioned = True
+        # Write the partition table out once, rather than after every single
+        # partition.  Volumes without any partitions don't get a table.
+        if partitioned:
+            image.commit()
         # Now since we're done, we need to do a second pass to copy the data
         # and set all the partition types.  This needs to be done like this as
         # libparted's commit() operation resets type GUIDs to defaults and
@@ -568,8 +650,7 @@ class AbstractImageBuilderState(State):
             image.copy_blob(volume.part_images[i],
                             bs=image.sector_size,
                             seek=part.offset // image.sector_size,
-                            count=ceil(part.size / image.sector_size),
-                            conv='notrunc')
+                            count=ceil(part.size / image.sector_size))
             if part.role is StructureRole.mbr or part.type == 'bare':
                 continue
             image.set_parition_type(part_id, part.type)
@@ -10,6 +10,7 @@ import contextlib
 
 from contextlib import ExitStack, contextmanager
 from distutils.spawn import find_executable
+from glob import glob
 from parted import Device
 from subprocess import DEVNULL, PIPE, run as subprocess_run
 from tempfile import NamedTemporaryFile, TemporaryDirectory
@@ -42,22 +43,27 @@ def MiB(count):
     return count * 2**20
 
 
+_FALSE_VALUES = frozenset({
+    'no',
+    'false',
+    '0',
+    'disable',
+    'disabled',
+    })
+_TRUE_VALUES = frozenset({
+    'yes',
+    'true',
+    '1',
+    'enable',
+    'enabled',
+    })
+
+
 def as_bool(value):
-    if value.lower() in {
-            'no',
-            'false',
-            '0',
-            'disable',
-            'disabled',
-            }:
+    lower_value = value.lower()
+    if lower_value in _FALSE_VALUES:
         return False
-    if value.lower() in {
-            'yes',
-            'true',
-            '1',
-            'enable',
-            'enabled',
-            }:
+    if lower_value in _TRUE_VALUES:
         return True
     raise ValueError(value)
 
@@ -66,16 +72,22 @@ def straight_up_bytes(count):
     return count
 
 
+# as_size() is called for every size and offset in the gadget.yaml, so
+# compile the pattern and build the suffix table only once.
+_SIZE_RE = re.compile(r'(\d+)([a-zA-Z]*)')
+_SIZE_UNITS = {
+    '': straight_up_bytes,
+    'G': GiB,
+    'M': MiB,
+    }
+
+
 def as_size(size, min=0, max=None):
-    mo = re.match(r'(\d+)([a-zA-Z]*)', size)
+    mo = _SIZE_RE.match(size)
     if mo is None:
         raise ValueError(size)
     size_in_bytes = mo.group(1)
-    value = {
-        '': straight_up_bytes,
-        'G': GiB,
-        'M': MiB,
-        }[mo.group(2)](int(size_in_bytes))
+    value = _SIZE_UNITS[mo.group(2)](int(size_in_bytes))
     if max is None:
         if value < min:
             raise ValueError('Value outside range: {} < {}'.format(value, min))
@@ -86,12 +98,13 @@ def as_size(size, min=0, max=None):
 
 
 def get_host_arch():
-    proc = run('dpkg --print-architecture', check=False)
+    proc = run('dpkg --print-architecture',
+               check=False, capture=True, stderr=DEVNULL)
     return proc.stdout.strip() if proc.returncode == 0 else None
 
 
 def get_host_distro():
-    proc = run('lsb_release -c -s', check=False)
+    proc = run('lsb_release -c -s', check=False, capture=True, stderr=DEVNULL)
     return proc.stdout.strip() if proc.returncode == 0 else None
 
 
@@ -104,16 +117,21 @@ def get_qemu_static_for_arch(arch):
     return 'qemu-{}-static'.format(archs.get(arch, arch))
 
 
-def run(command, *, check=True, **args):
+def run(command, *, check=True, capture=False, **args):
     runnable_command = (
         command.split() if isinstance(command, str) and 'shell' not in args
         else command)
-    stdout = args.pop('stdout', PIPE)
+    # Most commands are only run for their side effects, and some of them
+    # (e.g. mkfs.ext4 -d) can be very chatty on stdout.  Don't drain stdout
+    # unless the caller asks to capture it.  stderr is always captured so that
+    # it can be logged if the command fails.
+    stdout = args.pop('stdout', PIPE if capture else DEVNULL)
     stderr = args.pop('stderr', PIPE)
+    # Only set up output decoding when there's some output for us to read.
     proc = subprocess_run(
         runnable_command,
         stdout=stdout, stderr=stderr,
-        universal_newlines=True,
+        universal_newlines=PIPE in (stdout, stderr),
         **args)
     if check and proc.returncode != 0:
         _logger.error('COMMAND FAILED: %s', command)
@@ -167,9 +185,17 @@ def live_build(root_dir, env, enable_cross_build=True):
     arch = env.get('ARCH', None)
     auto_src = os.environ.get('UBUNTU_IMAGE_LIVECD_ROOTFS_AUTO_PATH')
     if auto_src is None:
-        proc = run('dpkg -L livecd-rootfs | grep "auto$"', shell=True,
-                   env=os.environ)
-        auto_src = proc.stdout.strip()
+        # Look for the auto directory in the package listing ourselves rather
+        # than piping it through grep in a shell.
+        proc = run('dpkg -L livecd-rootfs', capture=True, env=os.environ)
+        for line in proc.stdout.splitlines():
+            if line.endswith('auto'):
+                auto_src = line.strip()
+                break
+        else:
+            raise DependencyError(
+                'livecd-rootfs',
+                'Its auto scripts directory could not be found.')
     auto_dst = os.path.join(root_dir, 'auto')
     shutil.copytree(auto_src, auto_dst)
     # Create the commands and run config and build steps.
@@ -259,7 +285,9 @@ def mkfs_ext4(img_file, contents_dir, image_type, label='writable',
     cmd = ('{} mkfs.ext4 -L {} -O -metadata_csum -T default '
            '-O uninit_bg {} -d {}').format(sudo_cmd, label, img_file,
                                            contents_dir)
-    proc = run(cmd, check=False)
+    # Only the exit status matters here; a failure just means we have to fall
+    # back to the old way below.
+    proc = run(cmd, check=False, stderr=DEVNULL)
     if proc.returncode == 0:
         # We have a new enough e2fsprogs, so we're done.
         return                                      # pragma: noxenial
@@ -272,8 +300,10 @@ def mkfs_ext4(img_file, contents_dir, image_type, label='writable',
         preserve_flags = 'mode,timestamps'
         if preserve_ownership:
             preserve_flags += ',ownership'
-        run('sudo cp -dR --preserve={} {}/* {}'.format(
-            preserve_flags, contents_dir, mountpoint), shell=True)
+        # Hand cp every top level entry of the contents directory, as the
+        # shell's `*` used to, but without spawning a shell for it.
+        run(['sudo', 'cp', '-dR', '--preserve={}'.format(preserve_flags)] +
+            sorted(glob(os.path.join(contents_dir, '*'))) + [mountpoint])
 
 
 def get_default_sector_size():
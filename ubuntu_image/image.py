@@ -1,6 +1,7 @@
 """Classes for creating a bootable image."""
 
 import os
+import errno
 import parted
 
 from json import loads as load_json
@@ -53,30 +54,54 @@ class Image:
             self.disk = parted.freshDisk(self.device, label)
             self.sector_size = self.device.sectorSize
 
-    def copy_blob(self, blob_path, **dd_args):
+    def copy_blob(self, blob_path, *, bs=1, seek=0, count=None):
         """Copy a blob to the image file.
 
-        The copy is done using ``dd`` for consistency.  The keyword arguments
-        are passed directly to the ``dd`` call.  See the dd(1) manpage for
-        details.
+        This is like ``dd conv=notrunc`` with the given block size, seek and
+        count, except that the data is copied inside the kernel with
+        sendfile(2) rather than by spawning ``dd``.  Holes in the input file
+        are skipped, leaving the image untouched there.  Unlike ``dd
+        conv=sparse`` though, blocks of zeros which are actually allocated in
+        the input file are still written.
 
         :param blob_path: File system path to the input file.
         :type blob_path: str
+        :param bs: Block size in bytes for ``seek`` and ``count``.
+        :type bs: int
+        :param seek: Number of blocks to skip at the start of the image.
+        :type seek: int
+        :param count: Copy at most this many blocks of the input file.  By
+            default the whole input file is copied.
+        :type count: int
         """
-        # Put together the dd command.
-        args = ['dd', 'of={}'.format(self.path), 'if={}'.format(blob_path),
-                'conv=sparse']
-        for key, value in dd_args.items():
-            args.append('{}={}'.format(key, value))
-        # Run the command.  We'll capture stderr for logging purposes.
-        #
-        # TBD:
-        # - check status of the returned CompletedProcess
-        # - handle errors
-        # - log stdout/stderr
-        run(args)
-
-    def partition(self, offset, size, name=None, is_bootable=False):
+        start = seek * bs
+        with open(blob_path, 'rb') as infp, open(self.path, 'rb+') as outfp:
+            in_fd = infp.fileno()
+            out_fd = outfp.fileno()
+            end = os.fstat(in_fd).st_size
+            if count is not None:
+                end = min(end, count * bs)
+            offset = 0
+            while offset < end:
+                # Skip to the next extent of data in the input file.
+                try:
+                    offset = os.lseek(in_fd, offset, os.SEEK_DATA)
+                except OSError as error:
+                    # There is no more data past the offset.
+                    if error.errno != errno.ENXIO:
+                        raise
+                    break
+                hole = min(os.lseek(in_fd, offset, os.SEEK_HOLE), end)
+                os.lseek(out_fd, start + offset, os.SEEK_SET)
+                while offset < hole:
+                    sent = os.sendfile(out_fd, in_fd, offset, hole - offset)
+                    if sent == 0:
+                        # The input file shrank underneath us.
+                        return
+                    offset += sent
+
+    def partition(self, offset, size, name=None, is_bootable=False,
+                  commit=True):
         """Add a new partition in the image file.
 
         The newly added partition will be appended to the existing partition
@@ -96,6 +121,10 @@ class Image:
         :type name: str
         :param is_bootable: Toggle if the bootable flag should be set.
         :type name: bool
+        :param commit: Write the partition table out to the image right away.
+            When adding several partitions, pass False and call commit()
+            once after the last one, so the table is only written once.
+        :type commit: bool
 
         """
         # When defining geometries for our partitions we can't use the pyparted
@@ -126,7 +155,13 @@ class Image:
             partition._Partition__partition.set_name(name)
         if is_bootable:
             partition.setFlag(parted.PARTITION_BOOT)
-        # Save all the partition changes so far to disk.
+        if commit:
+            self.commit()
+
+    def commit(self):
+        """Save all the partition changes so far to disk."""
+        if self.disk is None:
+            raise TypeError('No schema for device partition')
         self.disk.commit()
 
     def set_parition_type(self, partnum, typecode):
@@ -153,7 +188,7 @@ class Image:
         :return: Dictionary with disk parition information
         :rtype: dict
         """
-        status = run(['sfdisk', '--json', self.path])
+        status = run(['sfdisk', '--json', self.path], capture=True)
         disk_info = load_json(status.stdout)
         # TBD:
         # - check status
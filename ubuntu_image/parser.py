@@ -15,10 +15,17 @@ from voluptuous import (
     __version__ as voluptuous_version)
 from warnings import warn
 from yaml import load
-from yaml.loader import SafeLoader
 from yaml.parser import ParserError, ScannerError
 
 
+# Prefer the libyaml based loader, which scans and parses in C, falling back
+# to the pure Python implementation when PyYAML is built without libyaml.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:                                 # pragma: nocover
+    from yaml.loader import SafeLoader
+
+
 COLON = ':'
 _logger = logging.getLogger('ubuntu-image')
 
@@ -30,17 +37,21 @@ class GadgetSpecificationError(Exception):
 # By default PyYAML allows duplicate mapping keys, even though the YAML spec
 # prohibits this.  We can't validate this after parsing because PyYAML just
 # gives us a normal dictionary, which of course does not have duplicate keys.
-# We use the basic YAML SafeLoader but override the mapping constructor to
-# raise an exception if we see a key twice.
+# We use the basic YAML SafeLoader (or its libyaml equivalent) but override the
+# mapping constructor to raise an exception if we see a key twice.
 
 class StrictLoader(SafeLoader):
     def construct_mapping(self, node):
         pairs = self.construct_pairs(node)
-        mapping = {}
-        for key, value in pairs:
-            if key in mapping:
-                raise GadgetSpecificationError('Duplicate key: {}'.format(key))
-            mapping[key] = value
+        mapping = dict(pairs)
+        if len(mapping) != len(pairs):
+            # Only go looking for the duplicate when we know there is one.
+            seen = set()
+            for key, value in pairs:                # pragma: no branch
+                if key in seen:
+                    raise GadgetSpecificationError(
+                        'Duplicate key: {}'.format(key))
+                seen.add(key)
         return mapping
 
 
@@ -100,11 +111,18 @@ class Enumify:
     def __init__(self, enum_class, msg=None, preprocessor=None):
         self.enum_class = enum_class
         self.preprocessor = preprocessor
+        # The same handful of values appear over and over again in a
+        # gadget.yaml, so remember which member each raw value maps to.
+        self._members = {}
 
     def __call__(self, v):
+        try:
+            return self._members[v]
+        except KeyError:
+            pass
         # Turn KeyErrors into spec errors.
         try:
-            return self.enum_class[
+            member = self.enum_class[
                 v if self.preprocessor is None
                 else self.preprocessor(v)
                 ]
@@ -112,6 +130,8 @@ class Enumify:
             raise GadgetSpecificationError(
                 "Invalid gadget.yaml value '{}' @ {}".format(
                     v, self.enum_class.yaml_path)) from error
+        self._members[v] = member
+        return member
 
 
 def Size32bit(v):
@@ -119,6 +139,9 @@ def Size32bit(v):
     return as_size(v, max=GiB(4))
 
 
+_HEX2_RE = re.compile('^[a-fA-F0-9]{2}$')
+
+
 def Id(v):
     """Coerce to either a hex UUID, a 2-digit hex value."""
     # Yes, we actually do want this function to raise ValueErrors instead of
@@ -127,7 +150,7 @@ def Id(v):
         return UUID(hex=v)
     except ValueError:
         pass
-    mo = re.match('^[a-fA-F0-9]{2}$', v)
+    mo = _HEX2_RE.match(v)
     if mo is None:
         raise ValueError(v)
     return mo.group(0).upper()
@@ -178,6 +201,54 @@ def YAMLFormat(v):
     return value
 
 
+# The nested schemas are all compiled once, at import time.  Give the deeper
+# ones names so that the overall structure of GadgetYAML is easier to follow.
+_CONTENT_A = Schema({
+    Required('source'): str,
+    Required('target'): str,
+    })
+
+
+_CONTENT_B = Schema({
+    Required('image'): str,
+    Optional('offset'): Coerce(as_size),
+    Optional('offset-write'): Any(Coerce(Size32bit), RelativeOffset),
+    Optional('size'): Coerce(as_size),
+    })
+
+
+_STRUCTURE = Schema({
+    Optional('name'): str,
+    Optional('offset'): Coerce(as_size),
+    Optional('offset-write'): Any(Coerce(Size32bit), RelativeOffset),
+    Required('size'): Coerce(as_size),
+    Required('type'): Any('mbr', 'bare', Coerce(HybridId)),
+    Optional('role'): Enumify(
+        StructureRole, preprocessor=methodcaller('replace', '-', '_')),
+    Optional('id'): Coerce(UUID),
+    Optional('filesystem', default='none' if has_new_voluptuous()
+             else FileSystemType.none):
+    Enumify(FileSystemType),
+    Optional('filesystem-label'): str,
+    Optional('content'): Any([_CONTENT_A], [_CONTENT_B]),
+    Optional('update'): Schema({
+        Optional('edition'): All(Coerce(int), Range(min=0, min_included=True)),
+        Optional('preserve'): [str],
+        }),
+    })
+
+
+_VOLUME = Schema({
+    Optional('schema', default='gpt' if has_new_voluptuous()
+             else VolumeSchema.gpt):
+    Enumify(VolumeSchema),
+    Optional('bootloader'): Enumify(
+        BootLoader, preprocessor=methodcaller('replace', '-', '')),
+    Optional('id'): Coerce(Id),
+    Required('structure'): [_STRUCTURE],
+    })
+
+
 GadgetYAML = Schema({
     Optional('defaults'): {
         str: {
@@ -193,49 +264,7 @@ GadgetYAML = Schema({
     Optional('device-tree'): str,
     Optional('format'): YAMLFormat,
     Required('volumes'): {
-        Match('^[a-zA-Z0-9][-a-zA-Z0-9]*$'): Schema({
-            Optional('schema', default='gpt' if has_new_voluptuous()
-                     else VolumeSchema.gpt):
-            Enumify(VolumeSchema),
-            Optional('bootloader'): Enumify(
-                BootLoader, preprocessor=methodcaller('replace', '-', '')),
-            Optional('id'): Coerce(Id),
-            Required('structure'): [Schema({
-                Optional('name'): str,
-                Optional('offset'): Coerce(as_size),
-                Optional('offset-write'): Any(
-                    Coerce(Size32bit), RelativeOffset),
-                Required('size'): Coerce(as_size),
-                Required('type'): Any('mbr', 'bare', Coerce(HybridId)),
-                Optional('role'): Enumify(
-                    StructureRole,
-                    preprocessor=methodcaller('replace', '-', '_')),
-                Optional('id'): Coerce(UUID),
-                Optional('filesystem', default='none' if has_new_voluptuous()
-                         else FileSystemType.none):
-                Enumify(FileSystemType),
-                Optional('filesystem-label'): str,
-                Optional('content'): Any(
-                    [Schema({
-                        Required('source'): str,
-                        Required('target'): str,
-                        })
-                    ],                                  # noqa: E124
-                    [Schema({
-                        Required('image'): str,
-                        Optional('offset'): Coerce(as_size),
-                        Optional('offset-write'): Any(
-                            Coerce(Size32bit), RelativeOffset),
-                        Optional('size'): Coerce(as_size),
-                        })],
-                ),
-                Optional('update'): Schema({
-                    Optional('edition'): All(
-                        Coerce(int), Range(min=0, min_included=True)),
-                    Optional('preserve'): [str],
-                }),
-            })]
-        })
+        Match('^[a-zA-Z0-9][-a-zA-Z0-9]*$'): _VOLUME,
     }
 })
 
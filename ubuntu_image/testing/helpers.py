@@ -148,10 +148,11 @@ class LiveBuildMocker:
             return SimpleNamespace(returncode=1)
         elif cmd_str.startswith('dpkg -L'):
             self.call_args_list.append(command)
+            kws.pop('capture', None)
             stdout = kws.pop('stdout', PIPE)
             stderr = kws.pop('stderr', PIPE)
             return subprocess_run(
-                command,
+                command.split() if isinstance(command, str) else command,
                 stdout=stdout, stderr=stderr,
                 universal_newlines=True,
                 **kws)
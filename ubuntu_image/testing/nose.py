@@ -8,6 +8,7 @@ import os
 import re
 import shutil
 import doctest
+import tempfile
 
 from contextlib import ExitStack
 from hashlib import sha256
@@ -177,6 +178,15 @@ class NosePlugin(Plugin):
         # variable to see if the mocking should even be done.  This way, we
         # can make our Travis-CI job do at least one real end-to-end test.
         self.resources = ExitStack()
+        # Optionally put all the temporary files and directories the tests
+        # create somewhere other than $TMPDIR, e.g. on a tmpfs like /dev/shm.
+        # This isn't the default because /dev/shm is often too small to hold
+        # the test images.
+        tests_tmpdir = os.environ.get('UBUNTU_IMAGE_TESTS_TMPDIR')
+        if tests_tmpdir is not None:
+            self.resources.callback(
+                setattr, tempfile, 'tempdir', tempfile.tempdir)
+            tempfile.tempdir = tests_tmpdir
         # How should we mock `snap prepare-image`?  If set to 'always' (case
         # insensitive), then use the sample data in the .zip file.  Any other
         # truthy value says to use a second-and-onward mock.
@@ -198,6 +208,25 @@ class NosePlugin(Plugin):
     def stopTestRun(self, event):
         self.resources.close()
 
+    # When the tests are run in parallel with nose2's multiprocess plugin
+    # (i.e. `nose2 -N <processes>`), every worker process needs to set up its
+    # own snap mock.
+
+    def registerInSubprocess(self, event):
+        event.pluginClasses.append(self.__class__)
+
+    def startSubprocess(self, event):
+        # A forked worker inherits the snap mock the parent process already
+        # started, so stop that one first, otherwise only our own mock would
+        # get stopped when the worker finishes.
+        if self.__class__.snap_mocker is not None:
+            self.__class__.snap_mocker.patcher.stop()
+            self.__class__.snap_mocker = None
+        self.startTestRun(event)
+
+    def stopSubprocess(self, event):
+        self.stopTestRun(event)
+
     # def startTest(self, event):
     #     import sys; print('vvvvv', event.test, file=sys.stderr)
 
@@ -6,12 +6,13 @@ import json
 import logging
 
 from contextlib import ExitStack
-from itertools import product
+from math import ceil
 from pkg_resources import resource_filename
 from shutil import SpecialFileError
 from struct import unpack
 from subprocess import CalledProcessError
 from tempfile import NamedTemporaryFile, TemporaryDirectory
+from threading import Event
 from types import SimpleNamespace
 from ubuntu_image.helpers import DoesNotFit, MiB, run
 from ubuntu_image.parser import (
@@ -27,11 +28,49 @@ NL = '\n'
 COMMASPACE = ', '
 
 
+# 2016-08-01 barry@ubuntu.com: Since these tests currently use real data, the
+# snap version numbers may change.  Until we use test data (sideloaded) do
+# regexp matches against specific snap file names.
+_SEED_PATTERNS = tuple(re.compile(pattern) for pattern in (
+    r'^pc-kernel_[0-9]+\.snap$',
+    r'^pc_[0-9]+\.snap$',
+    # This snap's name is undergoing transition.
+    r'^(ubuntu-)?core_[0-9]+\.snap$',
+    ))
+# All of the above as a single alternation, with a named group per pattern
+# telling us which one matched.
+_SEED_UNION = re.compile('|'.join(
+    '(?P<p{}>{})'.format(index, pattern.pattern)
+    for index, pattern in enumerate(_SEED_PATTERNS)))
+# Every file matching one of the patterns starts with one of these.
+_SEED_PREFIXES = ('pc', 'core_', 'ubuntu-core_')
+
+
 # For convenience.
 def utf8open(path):
     return open(path, 'r', encoding='utf-8')
 
 
+def _walk_set(root):
+    # Every path in the tree under root, collected with a single scandir()
+    # walk instead of a stat() per path we want to check.
+    present = set()
+    dirs = [root]
+    while dirs:
+        for entry in os.scandir(dirs.pop()):
+            present.add(entry.path)
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+    return present
+
+
+def opener_at(dir_fd):
+    # An opener for open() which looks up relative paths from dir_fd.
+    def opener(path, flags):
+        return os.open(path, flags, dir_fd=dir_fd)
+    return opener
+
+
 # For forcing a test failure.
 def check_returncode(*args, **kws):
     raise CalledProcessError(1, 'failing command')
@@ -66,11 +105,15 @@ class TestModelAssertionBuilder(TestCase):
     # XXX These tests also requires root, because `snap prepare-image`
     # currently requires it.  mvo says this will be fixed.
 
+    @classmethod
+    def setUpClass(cls):
+        # The test data doesn't move around, so only look it up once.
+        cls.model_assertion = resource_filename(
+            'ubuntu_image.tests.data', 'model.assertion')
+
     def setUp(self):
         self._resources = ExitStack()
         self.addCleanup(self._resources.close)
-        self.model_assertion = resource_filename(
-            'ubuntu_image.tests.data', 'model.assertion')
 
     @skipIf('UBUNTU_IMAGE_TESTS_NO_NETWORK' in os.environ,
             'Cannot run this test without network access')
@@ -102,45 +145,45 @@ class TestModelAssertionBuilder(TestCase):
             '{boot}/EFI/ubuntu/grubenv',
             '{root}/system-data/boot/',
             ]
-        for filename in files:
-            path = filename.format(
-                root=state.rootfs,
-                boot=state.gadget.volumes['pc'].bootfs,
-                )
-            self.assertTrue(os.path.exists(path), path)
-        # 2016-08-01 barry@ubuntu.com: Since these tests currently use real
-        # data, the snap version numbers may change.  Until we use test data
-        # (sideloaded) do regexp matches against specific snap file names.
+        bootfs = state.gadget.volumes['pc'].bootfs
+        # Drop the trailing slash from directories.
+        expected = [
+            os.path.normpath(filename.format(root=state.rootfs, boot=bootfs))
+            for filename in files
+            ]
+        present = _walk_set(state.rootfs) | _walk_set(bootfs)
+        missing = [path for path in expected if path not in present]
+        self.assertEqual(missing, [])
         seeds_path = os.path.join(
             state.rootfs, 'system-data',
             'var', 'lib', 'snapd', 'seed', 'snaps')
         snaps = set(os.listdir(seeds_path))
-        seed_patterns = [
-            '^pc-kernel_[0-9]+.snap$',
-            '^pc_[0-9]+.snap$',
-            # This snap's name is undergoing transition.
-            '^(ubuntu-)?core_[0-9]+.snap$',
-            ]
         # Make sure every file matches a pattern and every pattern matches a
         # file.
         patterns_matched = set()
         files_matched = set()
-        matches = []
-        for pattern, snap in product(seed_patterns, snaps):
-            if pattern in patterns_matched or snap in files_matched:
+        for snap in snaps:
+            # Cheaply rule out the obvious mismatches before the regexp.
+            if not snap.startswith(_SEED_PREFIXES):
+                continue
+            mo = _SEED_UNION.fullmatch(snap)
+            if mo is None:
+                continue
+            pattern = _SEED_PATTERNS[int(mo.lastgroup[1:])]
+            # Each pattern only gets to match one file.
+            if pattern in patterns_matched:
                 continue
-            if re.match(pattern, snap):
-                matches.append((pattern, snap))
-                patterns_matched.add(pattern)
-                files_matched.add(snap)
-        patterns_unmatched = set(seed_patterns) - patterns_matched
+            patterns_matched.add(pattern)
+            files_matched.add(snap)
+        patterns_unmatched = set(_SEED_PATTERNS) - patterns_matched
         files_unmatched = snaps - files_matched
         self.assertEqual(
             (len(patterns_unmatched), len(files_unmatched)),
             (0, 0),
             'Unmatched patterns: {}\nUnmatched files: {}'.format(
-                COMMASPACE.join(patterns_unmatched),
-                COMMASPACE.join(files_unmatched)))
+                COMMASPACE.join(
+                    sorted(pattern.pattern for pattern in patterns_unmatched)),
+                COMMASPACE.join(sorted(files_unmatched))))
 
     def test_populate_rootfs_contents_without_cloud_init(self):
         with ExitStack() as resources:
@@ -219,9 +262,11 @@ class TestModelAssertionBuilder(TestCase):
             state._next.append(state.populate_rootfs_contents)
             next(state)
             # Everything except /boot and /home got copied.
+            root_fd = os.open(state.rootfs, os.O_RDONLY | os.O_DIRECTORY)
+            resources.callback(os.close, root_fd)
             for subdir in ('var/lib/foo', 'etc', 'stuff', 'home'):
-                path = os.path.join(state.rootfs, 'system-data', subdir)
-                with open(os.path.join(path, 'sentinel.dat'), 'rb') as fp:
+                path = os.path.join('system-data', subdir, 'sentinel.dat')
+                with open(path, 'rb', opener=opener_at(root_fd)) as fp:
                     self.assertEqual(fp.read(), b'x' * 25)
             # But these directories did not get copied.
             boot = os.path.join(state.rootfs, 'boot')
@@ -261,9 +306,11 @@ class TestModelAssertionBuilder(TestCase):
             next(state)
             # Everything got copied (i.e. /boot too) into the rootfs,
             # no system-data prefix
+            root_fd = os.open(state.rootfs, os.O_RDONLY | os.O_DIRECTORY)
+            resources.callback(os.close, root_fd)
             for subdir in ('var/lib/foo', 'etc', 'stuff', 'boot'):
-                path = os.path.join(state.rootfs,  subdir)
-                with open(os.path.join(path, 'sentinel.dat'), 'rb') as fp:
+                path = os.path.join(subdir, 'sentinel.dat')
+                with open(path, 'rb', opener=opener_at(root_fd)) as fp:
                     self.assertEqual(fp.read(), b'x' * 25)
 
     def test_populate_rootfs_contents_remove_empty_etc_cloud(self):
@@ -537,11 +584,17 @@ class TestModelAssertionBuilder(TestCase):
                 source='nested/',
                 target='EFI/ubuntu/',
                 )
+            # A second file copied into an already existing target directory.
+            contents5 = SimpleNamespace(
+                source='as.dat',
+                target='EFI/ubuntu/as.dat',
+                )
             part = SimpleNamespace(
                 role=StructureRole.system_boot,
                 filesystem_label='not a boot',
                 filesystem=FileSystemType.ext4,
-                content=[contents1, contents2, contents3, contents4],
+                content=[contents1, contents2, contents3, contents4,
+                         contents5],
                 )
             volume = SimpleNamespace(
                 bootloader=BootLoader.grub,
@@ -604,6 +657,7 @@ class TestModelAssertionBuilder(TestCase):
                 'EFI/ubuntu/very/much/much.cfg': b'from-gadget',
                 'EFI/ubuntu/1': b'from-image-boot-grub',
                 'EFI/ubuntu/2': b'from-gadget',
+                'EFI/ubuntu/as.dat': b'01234',
                 # Copied from image/boot/grrub generated content, not
                 # overwritten by gadget files
                 'EFI/ubuntu/grub.cfg': b'from-image-boot-grub',
@@ -1110,6 +1164,110 @@ class TestModelAssertionBuilder(TestCase):
             self.assertEqual(
                 str(cm.exception), 'Invalid part filesystem type: 801')
 
+    def test_populate_filesystems_first_failure_wins(self):
+        # The structures are populated concurrently, but when more than one
+        # fails, the exception raised is that of the first failing structure
+        # in the volume, not of the first one to fail.  The structures after
+        # it still run to completion.
+        with ExitStack() as resources:
+            workdir = resources.enter_context(TemporaryDirectory())
+            unpackdir = resources.enter_context(TemporaryDirectory())
+            # Fast forward a state machine to the method under test.
+            args = SimpleNamespace(
+                cloud_init=None,
+                output=None,
+                output_dir=None,
+                unpackdir=unpackdir,
+                workdir=workdir,
+                hooks_directory=[],
+                disk_info=None,
+                disable_console_conf=False,
+                cmd='snap',
+                )
+            # Jump right to the method under test.
+            state = resources.enter_context(XXXModelAssertionBuilder(args))
+            state._next.pop()
+            state._next.append(state.populate_filesystems)
+            # Set up expected state.
+            state.unpackdir = unpackdir
+            state.images = os.path.join(workdir, '.images')
+            os.makedirs(state.images)
+            part_images = [
+                os.path.join(state.images, 'part{}.img'.format(partnum))
+                for partnum in range(3)
+                ]
+            # Craft a gadget specification.  The first structure's content
+            # doesn't fit, the second one is an ext4 file system which is
+            # still being created when that's found out, and creating the
+            # third one's ext4 file system fails.
+            contents = SimpleNamespace(
+                image='image1.img',
+                size=None,
+                offset=None,
+                )
+            part0 = SimpleNamespace(
+                name='first',
+                role=None,
+                filesystem=FileSystemType.none,
+                content=[contents],
+                size=10,
+                )
+            part1 = SimpleNamespace(
+                role=None,
+                filesystem=FileSystemType.ext4,
+                filesystem_label='second',
+                )
+            part2 = SimpleNamespace(
+                role=None,
+                filesystem=FileSystemType.ext4,
+                filesystem_label='third',
+                )
+            volume = SimpleNamespace(
+                structures=[part0, part1, part2],
+                schema=VolumeSchema.gpt,
+                bootloader=BootLoader.grub,
+                )
+            state.gadget = SimpleNamespace(
+                volumes=dict(volume1=volume),
+                seeded=False,
+                )
+            prep_state(state, workdir, part_images)
+            # The source image.
+            gadget_dir = os.path.join(unpackdir, 'gadget')
+            os.makedirs(gadget_dir)
+            with open(os.path.join(gadget_dir, 'image1.img'), 'wb') as fp:
+                fp.write(b'\1' * 47)
+            # The first structure only finds out that its content doesn't fit,
+            # and the second structure's mkfs.ext4 only finishes, after the
+            # third structure's mkfs.ext4 has failed.
+            third_failed = Event()
+            finished = []
+            real_getsize = os.path.getsize
+
+            def getsize(path):
+                self.assertTrue(third_failed.wait(10))
+                return real_getsize(path)
+
+            def mkfs_ext4(img_file, contents_dir, image_type, label):
+                if label == 'third':
+                    third_failed.set()
+                    raise CalledProcessError(1, 'mkfs.ext4')
+                self.assertTrue(third_failed.wait(10))
+                finished.append(label)
+
+            resources.enter_context(patch(
+                'ubuntu_image.common_builder.os.path.getsize',
+                side_effect=getsize))
+            resources.enter_context(patch(
+                'ubuntu_image.common_builder.mkfs_ext4',
+                side_effect=mkfs_ext4))
+            with self.assertRaises(DoesNotFit) as cm:
+                next(state)
+            self.assertEqual(cm.exception.part_number, 0)
+            self.assertEqual(
+                cm.exception.part_path, 'volumes:<volume1>:structure:<first>')
+            self.assertEqual(finished, ['second'])
+
     def test_populate_filesystems_lk_bootloader(self):
         # We check that boot.img and snapbootsel.bin are copied around so
         # they can be used when creating the image from gadget.yaml.
@@ -1357,11 +1515,53 @@ class TestModelAssertionBuilder(TestCase):
             self.assertEqual(len(run_mock.call_args_list), 1)
             posargs, kwargs = run_mock.call_args_list[0]
             # Check if the right arguments were passed to mcopy.
-            mcopy_cmd = posargs[0]
-            self.assertTrue(
-                mcopy_cmd.startswith('mcopy -s -i {} '.format(part1_img)))
-            self.assertIn(file1_path, mcopy_cmd)
-            self.assertIn(file2_path, mcopy_cmd)
+            self.assertEqual(
+                posargs[0],
+                ['mcopy', '-s', '-i', part1_img, file1_path, file2_path, '::'])
+
+    def test_populate_filesystems_empty_vfat(self):
+        # There's no need to run mcopy when there is nothing to copy into a
+        # vfat partition.
+        with ExitStack() as resources:
+            workdir = resources.enter_context(TemporaryDirectory())
+            # Fast forward a state machine to the method under test.
+            args = SimpleNamespace(
+                cloud_init=None,
+                output=None,
+                output_dir=None,
+                unpackdir=None,
+                workdir=workdir,
+                hooks_directory=[],
+                disk_info=None,
+                disable_console_conf=False,
+                cmd='snap',
+                )
+            # Jump right to the method under test.
+            state = resources.enter_context(XXXModelAssertionBuilder(args))
+            state._next.pop()
+            state._next.append(state.populate_filesystems)
+            # Craft a gadget specification.
+            part0 = SimpleNamespace(
+                role=StructureRole.system_boot,
+                filesystem=FileSystemType.vfat,
+                size=MiB(1),
+                )
+            volume = SimpleNamespace(
+                structures=[part0],
+                schema=VolumeSchema.gpt,
+                bootloader=BootLoader.grub,
+                )
+            state.gadget = SimpleNamespace(
+                volumes=dict(volume1=volume),
+                seeded=False,
+                )
+            part0_img = os.path.join(workdir, 'part0.img')
+            prep_state(state, workdir, [part0_img])
+            os.makedirs(os.path.join(volume.basedir, 'part0'))
+            run_mock = resources.enter_context(
+                patch('ubuntu_image.common_builder.run'))
+            next(state)
+            self.assertEqual(len(run_mock.call_args_list), 0)
 
     def test_make_disk(self):
         # make_disk() will use Image with the msdos label with the mbr schema.
@@ -1535,7 +1735,7 @@ class TestModelAssertionBuilder(TestCase):
                 fp.seek(MiB(5))
                 self.assertEqual(fp.read(15), b'\4' * 14 + b'\0')
             # Verify the disk image's partition table.
-            proc = run('sfdisk --json {}'.format(disk_img))
+            proc = run('sfdisk --json {}'.format(disk_img), capture=True)
             layout = json.loads(proc.stdout)
             partitions = [
                 (part['name'] if 'name' in part else None, part['start'])
@@ -1625,7 +1825,7 @@ class TestModelAssertionBuilder(TestCase):
             next(state)
             # Verify the disk image's partition table.
             disk_img = os.path.join(outputdir, 'volume1.img')
-            proc = run('sfdisk --json {}'.format(disk_img))
+            proc = run('sfdisk --json {}'.format(disk_img), capture=True)
             layout = json.loads(proc.stdout)
             partitions = [
                 (part['name'] if 'name' in part else None, part['start'])
@@ -1712,7 +1912,7 @@ class TestModelAssertionBuilder(TestCase):
                 fp.seek(MiB(5))
                 self.assertEqual(fp.read(15), b'\4' * 14 + b'\0')
             # Verify the disk image's partition table.
-            proc = run('sfdisk --json {}'.format(img_file))
+            proc = run('sfdisk --json {}'.format(img_file), capture=True)
             layout = json.loads(proc.stdout)
             partitions = [
                 (part['name'] if 'name' in part else None, part['start'])
@@ -1842,7 +2042,7 @@ class TestModelAssertionBuilder(TestCase):
                 fp.seek(MiB(5))
                 self.assertEqual(fp.read(15), b'\4' * 14 + b'\0')
             # Verify the disk image's partition table.
-            proc = run('sfdisk --json {}'.format(disk_img))
+            proc = run('sfdisk --json {}'.format(disk_img), capture=True)
             layout = json.loads(proc.stdout)
             partitions = [
                 (part['name'] if 'name' in part else None, part['start'])
@@ -1922,7 +2122,7 @@ class TestModelAssertionBuilder(TestCase):
             next(state)
             # Verify the disk image's partition table.
             disk_img = os.path.join(outputdir, 'volume1.img')
-            proc = run('sfdisk --json {}'.format(disk_img))
+            proc = run('sfdisk --json {}'.format(disk_img), capture=True)
             layout = json.loads(proc.stdout)
             partition1 = layout['partitiontable']['partitions'][0]
             self.assertTrue(partition1['bootable'])
@@ -2163,14 +2363,20 @@ class TestModelAssertionBuilder(TestCase):
                 seeded=False,
                 )
             prep_state(state, workdir)
-            # Mock the run() call to prove that we never call dd.
+            # Mock the run() call to prove that we never call mkfs.vfat.
             mock = resources.enter_context(
                 patch('ubuntu_image.common_builder.run'))
             next(state)
-            # There should be only one call to run() and that's for the dd.
-            self.assertEqual(len(mock.call_args_list), 1)
-            posargs, kwargs = mock.call_args_list[0]
-            self.assertTrue(posargs[0].startswith('dd if='))
+            # The images are created in-process, so there are no calls to
+            # run() at all.
+            self.assertEqual(len(mock.call_args_list), 0)
+            volume_dir = os.path.join(workdir, 'volumes', 'volume1')
+            self.assertEqual(
+                os.path.getsize(os.path.join(volume_dir, 'part0.img')),
+                MiB(1))
+            self.assertEqual(
+                os.path.getsize(os.path.join(volume_dir, 'part1.img')),
+                MiB(1))
 
     def test_prepare_filesystems_seeded_image(self):
         with ExitStack() as resources:
@@ -2830,7 +3036,7 @@ class TestModelAssertionBuilder(TestCase):
             next(state)
             # The root file system must be at least 947980 bytes.
             disk_img = os.path.join(outputdir, 'pi3.img')
-            proc = run('sfdisk --json {}'.format(disk_img))
+            proc = run('sfdisk --json {}'.format(disk_img), capture=True)
             layout = json.loads(proc.stdout)
             partition1 = layout['partitiontable']['partitions'][1]
             # sfdisk returns size in sectors.  947980 bytes rounded up to 512
@@ -3338,7 +3544,27 @@ class TestModelAssertionBuilder(TestCase):
             with open(os.path.join(state.rootfs, '.disk', 'info')) as fp:
                 self.assertEqual(fp.read(), 'Some disk info')
 
-    def test_du_command_fails(self):
+    def test_calculate_dirsize(self):
+        # The directory size matches what `du -s -B1` reports, plus the fudge
+        # factor.  Hard links are only counted once, and symlinks are not
+        # followed.
+        with ExitStack() as resources:
+            tmpdir = resources.enter_context(TemporaryDirectory())
+            make_content_at(tmpdir, {
+                'foo': b'x' * 10000,
+                'bar/baz': b'y' * 5000,
+                'bar/qux/quux': b'z' * 100000,
+                })
+            os.link(os.path.join(tmpdir, 'bar', 'qux', 'quux'),
+                    os.path.join(tmpdir, 'quux'))
+            os.symlink('bar', os.path.join(tmpdir, 'link'))
+            proc = run('du -s -B1 {}'.format(tmpdir), capture=True)
+            du_size = int(proc.stdout.split()[0])
+            self.assertEqual(
+                XXXModelAssertionBuilder._calculate_dirsize(tmpdir),
+                ceil(du_size * 1.5))
+
+    def test_dirsize_fails(self):
         with ExitStack() as resources:
             # Fast forward a state machine to the method under test.
             args = SimpleNamespace(
@@ -3361,24 +3587,19 @@ class TestModelAssertionBuilder(TestCase):
             state._next.pop()
             state._next.append(state.calculate_rootfs_size)
             resources.enter_context(patch(
-                'ubuntu_image.helpers.subprocess_run',
-                return_value=SimpleNamespace(
-                    returncode=1,
-                    stdout='command stdout',
-                    stderr='command stderr',
-                    check_returncode=check_returncode,
-                    )))
+                'ubuntu_image.common_builder.os.scandir',
+                side_effect=PermissionError(
+                    13, 'Permission denied', '/tmp')))
             log_capture = resources.enter_context(LogCapture())
             next(state)
             self.assertEqual(state.exitcode, 1)
             # Note that there is no traceback in the output.
             self.assertEqual(log_capture.logs, [
-                (logging.ERROR, 'COMMAND FAILED: du -s -B1 /tmp'),
-                (logging.ERROR, 'command stdout'),
-                (logging.ERROR, 'command stderr'),
+                (logging.ERROR, 'Unable to calculate the rootfs size: '
+                                "[Errno 13] Permission denied: '/tmp'"),
                 ])
 
-    def test_du_command_fails_debug(self):
+    def test_dirsize_fails_debug(self):
         with ExitStack() as resources:
             # Fast forward a state machine to the method under test.
             args = SimpleNamespace(
@@ -3401,20 +3622,15 @@ class TestModelAssertionBuilder(TestCase):
             state._next.pop()
             state._next.append(state.calculate_rootfs_size)
             resources.enter_context(patch(
-                'ubuntu_image.helpers.subprocess_run',
-                return_value=SimpleNamespace(
-                    returncode=1,
-                    stdout='command stdout',
-                    stderr='command stderr',
-                    check_returncode=check_returncode,
-                    )))
+                'ubuntu_image.common_builder.os.scandir',
+                side_effect=PermissionError(
+                    13, 'Permission denied', '/tmp')))
             log_capture = resources.enter_context(LogCapture())
             next(state)
             self.assertEqual(state.exitcode, 1)
             self.assertEqual(log_capture.logs, [
-                (logging.ERROR, 'COMMAND FAILED: du -s -B1 /tmp'),
-                (logging.ERROR, 'command stdout'),
-                (logging.ERROR, 'command stderr'),
+                (logging.ERROR, 'Unable to calculate the rootfs size: '
+                                "[Errno 13] Permission denied: '/tmp'"),
                 (logging.ERROR, 'Full debug traceback follows'),
                 ('IMAGINE THE TRACEBACK HERE'),
                 ])
@@ -888,8 +888,7 @@ class TestClassicBuilder(TestCase):
             self.assertEqual(state.exitcode, 1)
             # Note that there is no traceback in the output.
             self.assertEqual(log_capture.logs, [
-                (logging.ERROR,
-                 'COMMAND FAILED: dpkg -L livecd-rootfs | grep "auto$"'),
+                (logging.ERROR, 'COMMAND FAILED: dpkg -L livecd-rootfs'),
                 (logging.ERROR, 'command stdout'),
                 (logging.ERROR, 'command stderr'),
                 ])
@@ -939,8 +938,7 @@ class TestClassicBuilder(TestCase):
             self.assertEqual(state.exitcode, 1)
             # Note that there is traceback in the output now.
             self.assertEqual(log_capture.logs, [
-                (logging.ERROR,
-                 'COMMAND FAILED: dpkg -L livecd-rootfs | grep "auto$"'),
+                (logging.ERROR, 'COMMAND FAILED: dpkg -L livecd-rootfs'),
                 (logging.ERROR, 'command stdout'),
                 (logging.ERROR, 'command stderr'),
                 (logging.ERROR, 'Full debug traceback follows'),
@@ -1108,7 +1106,7 @@ class TestClassicBuilder(TestCase):
 
             def run_script(command, *, check=True, **args):
                 stdout = args.pop('stdout', PIPE)
-                stdout.write(test_output)
+                stdout.write(test_output.encode('utf-8'))
                 stdout.flush()
             resources.enter_context(patch(
                 'ubuntu_image.classic_builder.run',
@@ -8,9 +8,10 @@ import logging
 
 from collections import OrderedDict
 from contextlib import ExitStack
+from glob import glob
 from pkg_resources import resource_filename
 from shutil import copytree
-from subprocess import DEVNULL, run as subprocess_run
+from subprocess import DEVNULL, PIPE, run as subprocess_run
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 from types import SimpleNamespace
 from ubuntu_image.helpers import (
@@ -74,30 +75,32 @@ class MountMocker:
         self.dd_called = False
 
     def run(self, command, *args, **kws):
-        if 'mkfs.ext4' in command:
-            if '-d' in command.split():
+        cmd_str = command if isinstance(command, str) else ' '.join(command)
+        if 'mkfs.ext4' in cmd_str:
+            if '-d' in cmd_str.split():
                 # Simulate a failing call on <= Ubuntu 16.04 where mkfs.ext4
                 # doesn't yet support the -d optio.n
                 return SimpleNamespace(returncode=1)
             # Otherwise, pretend to have created an ext4 file system.
             pass
-        elif command.startswith('sudo mount'):
+        elif cmd_str.startswith('sudo mount'):
             # We don't want to require sudo for the test suite, so let's not
             # actually do the mount.  Instead, just record the mount point,
             # which will be a temporary directory, so that we can verify its
             # contents later.
-            self.mountpoint = command.split()[-1]
+            self.mountpoint = cmd_str.split()[-1]
             if self.contents_dir:
-                subprocess_run('cp {}/* {}'.format(
-                    self.contents_dir, self.mountpoint), shell=True,
+                subprocess_run(
+                    ['cp'] + glob(os.path.join(self.contents_dir, '*')) +
+                    [self.mountpoint],
                     stdout=DEVNULL, stderr=DEVNULL)
-        elif command.startswith('sudo umount'):
+        elif cmd_str.startswith('sudo umount'):
             # Just ignore the umount command since we never mounted anything,
             # and it's a temporary directory anyway.
             pass
-        elif command.startswith('sudo cp'):
+        elif cmd_str.startswith('sudo cp'):
             # Pass this command upward, but without the sudo.
-            subprocess_run(command[5:], *args, **kws)
+            subprocess_run(command[1:], *args, **kws)
             # Now, because mount() called from mkfs_ext4() will cull its own
             # temporary directory, and that tempdir is the mountpoint captured
             # above, copy the entire contents of the mount point directory to
@@ -106,11 +109,11 @@ class MountMocker:
             # We also want to somehow test if, when requested, the cp call has
             # the --preserve=ownership flag present.  There's no other nice
             # way of mocking this as everything else would require root.
-            if re.search(r'--preserve=[^ ]*ownership', command):
+            if re.search(r'--preserve=[^ ]*ownership', cmd_str):
                 self.preserves_ownership = True
-        elif command.startswith('dd'):
+        elif cmd_str.startswith('dd'):
             # dd is a safe command so we should just run it.
-            subprocess_run(command, shell=True, stdout=DEVNULL, stderr=DEVNULL)
+            subprocess_run(cmd_str.split(), stdout=DEVNULL, stderr=DEVNULL)
             self.dd_called = True
 
 
@@ -150,11 +153,8 @@ class TestHelpers(TestCase):
         self.assertRaises(ValueError, as_size, '10', min=4, max=8)
 
     def test_run(self):
-        with ExitStack() as resources:
-            log = resources.enter_context(LogCapture())
-            resources.enter_context(
-                patch('ubuntu_image.helpers.subprocess_run',
-                      return_value=FakeProc()))
+        with LogCapture() as log, patch('ubuntu_image.helpers.subprocess_run',
+                                        return_value=FakeProc()):
             run('/bin/false')
             self.assertEqual(log.logs, [
                 (logging.ERROR, 'COMMAND FAILED: /bin/false'),
@@ -173,10 +173,28 @@ class TestHelpers(TestCase):
                 (logging.ERROR, 'COMMAND FAILED: /bin/false'),
                 ])
 
+    def test_run_discards_stdout(self):
+        with patch('ubuntu_image.helpers.subprocess_run') as mock:
+            run('/bin/true', check=False)
+            posargs, kwargs = mock.call_args
+            self.assertIs(kwargs['stdout'], DEVNULL)
+            self.assertIs(kwargs['stderr'], PIPE)
+            self.assertTrue(kwargs['universal_newlines'])
+
+    def test_run_no_output_no_decoding(self):
+        with patch('ubuntu_image.helpers.subprocess_run') as mock:
+            run('/bin/true', check=False, stderr=DEVNULL)
+            posargs, kwargs = mock.call_args
+            self.assertFalse(kwargs['universal_newlines'])
+
+    def test_run_capture(self):
+        proc = run('echo captured', capture=True)
+        self.assertEqual(proc.stdout, 'captured\n')
+
     def test_as_bool(self):
-        for value in {'no', 'False', '0', 'DISABLE', 'DiSaBlEd'}:
+        for value in ('no', 'False', '0', 'DISABLE', 'DiSaBlEd'):
             self.assertFalse(as_bool(value), value)
-        for value in {'YES', 'tRUE', '1', 'eNaBlE', 'enabled'}:
+        for value in ('YES', 'tRUE', '1', 'eNaBlE', 'enabled'):
             self.assertTrue(as_bool(value), value)
         self.assertRaises(ValueError, as_bool, 'anything else')
 
@@ -379,6 +397,16 @@ class TestHelpers(TestCase):
                  'IMAGEFORMAT=ext4', 'EXTRA_PPAS=foo1/bar1 foo2',
                  'lb', 'build'])
 
+    def test_live_build_no_auto_dir(self):
+        with ExitStack() as resources:
+            tmpdir = resources.enter_context(TemporaryDirectory())
+            resources.enter_context(patch(
+                'ubuntu_image.helpers.run',
+                return_value=SimpleNamespace(stdout='/.\n/usr\n/usr/share\n')))
+            with self.assertRaises(DependencyError) as cm:
+                live_build(os.path.join(tmpdir, 'root_dir'), {})
+            self.assertEqual(cm.exception.name, 'livecd-rootfs')
+
     def test_live_build_env_livecd(self):
         with ExitStack() as resources:
             tmpdir = resources.enter_context(TemporaryDirectory())
@@ -1,6 +1,7 @@
 """Test image building."""
 
 import os
+import errno
 
 from contextlib import suppress
 from parted import IOException
@@ -10,6 +11,7 @@ from ubuntu_image.helpers import GiB, MiB
 from ubuntu_image.image import Image
 from ubuntu_image.parser import VolumeSchema
 from unittest import TestCase
+from unittest.mock import patch
 
 
 class TestImage(TestCase):
@@ -71,7 +73,7 @@ class TestImage(TestCase):
             fp.write(b'happyhappyjoyj')
         self.assertEqual(os.stat(blob_file).st_size, 446)
         image = Image(self.img, MiB(1))
-        image.copy_blob(blob_file, bs=446, count=1, conv='notrunc')
+        image.copy_blob(blob_file, bs=446, count=1)
         # At the top of the image file, there should be 27 Stimpy
         # Exclamations, followed by a happyhappyjoyj.
         with open(image.path, 'rb') as fp:
@@ -90,13 +92,63 @@ class TestImage(TestCase):
         with open(blob_file, 'wb') as fp:
             fp.write(b'x' * 100)
         image = Image(self.img, MiB(2))
-        image.copy_blob(blob_file, bs=773, seek=4, count=1, conv='notrunc')
+        image.copy_blob(blob_file, bs=773, seek=4, count=1)
         # The seek=4 skipped 4 blocks of 773 bytes.
         with open(image.path, 'rb') as fp:
             self.assertEqual(fp.read(3092), b'\0' * 3092)
             self.assertEqual(fp.read(100), b'x' * 100)
             self.assertEqual(fp.read(25), b'\0' * 25)
 
+    def test_copy_blob_sparse(self):
+        # Holes in the blob are skipped, and the data on both sides of them
+        # end up at the right offsets in the image.
+        blob_file = os.path.join(self.tmpdir, 'sparse.blob')
+        with open(blob_file, 'wb') as fp:
+            fp.write(b'x' * 100)
+            fp.seek(MiB(1))
+            fp.write(b'y' * 100)
+        image = Image(self.img, MiB(2))
+        # Copy only up to the middle of the second run of data.
+        image.copy_blob(blob_file, bs=2, seek=50, count=(MiB(1) + 50) // 2)
+        with open(image.path, 'rb') as fp:
+            self.assertEqual(fp.read(100), b'\0' * 100)
+            self.assertEqual(fp.read(100), b'x' * 100)
+            self.assertEqual(fp.read(MiB(1) - 100), b'\0' * (MiB(1) - 100))
+            self.assertEqual(fp.read(50), b'y' * 50)
+            self.assertEqual(fp.read(50), b'\0' * 50)
+
+    def test_copy_blob_seek_data_fails(self):
+        # Errors other than "no more data" when looking for the next extent
+        # of data in the blob are propagated.
+        blob_file = os.path.join(self.tmpdir, 'blob')
+        with open(blob_file, 'wb') as fp:
+            fp.write(b'x' * 100)
+        image = Image(self.img, MiB(1))
+        real_lseek = os.lseek
+
+        def lseek(fd, offset, whence):
+            if whence == os.SEEK_DATA:
+                raise OSError(errno.EIO, 'I/O error')
+            return real_lseek(fd, offset, whence)
+
+        with patch('ubuntu_image.image.os.lseek', side_effect=lseek):
+            with self.assertRaises(OSError) as cm:
+                image.copy_blob(blob_file)
+        self.assertEqual(cm.exception.errno, errno.EIO)
+
+    def test_copy_blob_shrinks(self):
+        # The blob getting truncated while it's being copied stops the copy
+        # instead of looping forever.
+        blob_file = os.path.join(self.tmpdir, 'blob')
+        with open(blob_file, 'wb') as fp:
+            fp.write(b'x' * 100)
+        image = Image(self.img, MiB(1))
+        with patch('ubuntu_image.image.os.sendfile', return_value=0) as mock:
+            image.copy_blob(blob_file)
+        self.assertEqual(mock.call_count, 1)
+        with open(image.path, 'rb') as fp:
+            self.assertEqual(fp.read(100), b'\0' * 100)
+
     def test_gpt_image_partitions(self):
         image = Image(self.img, MiB(10), VolumeSchema.gpt)
         image.partition(offset=MiB(4), size=MiB(1), name='grub')
@@ -137,6 +189,26 @@ class TestImage(TestCase):
                 }],
             })
 
+    def test_gpt_image_partitions_single_commit(self):
+        image = Image(self.img, MiB(10), VolumeSchema.gpt)
+        image.partition(offset=MiB(4), size=MiB(1), name='grub', commit=False)
+        image.partition(offset=MiB(5), size=MiB(4), commit=False)
+        self.assertEqual(len(image.disk.partitions), 2)
+        # Nothing has been written to the image yet.
+        with open(self.img, 'rb') as fp:
+            self.assertEqual(fp.read(MiB(1)), b'\0' * MiB(1))
+        image.commit()
+        disk_info = image.diagnostics()
+        partitions = disk_info['partitiontable']['partitions']
+        self.assertEqual(
+            [(p['start'], p['size']) for p in partitions],
+            [(8192, 2048), (10240, 8192)])
+        self.assertEqual(partitions[0]['name'], 'grub')
+
+    def test_commit_schema_required(self):
+        image = Image(self.img, MiB(1))
+        self.assertRaises(TypeError, image.commit)
+
     def test_write_value_at_offset(self):
         image = Image(self.img, MiB(2))
         image.write_value_at_offset(801, 130031)
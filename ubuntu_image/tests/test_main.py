@@ -252,16 +252,16 @@ class TestParseArgs(TestCase):
 class TestMain(TestCase):
     def setUp(self):
         super().setUp()
-        self._resources = ExitStack()
-        self.addCleanup(self._resources.close)
         # Capture builtin print() output.
         self._stdout = StringIO()
         self._stderr = StringIO()
-        self._resources.enter_context(
-            patch('argparse._sys.stdout', self._stdout))
+        stdout_patcher = patch('argparse._sys.stdout', self._stdout)
+        stdout_patcher.start()
+        self.addCleanup(stdout_patcher.stop)
         # Capture stderr since this is where argparse will spew to.
-        self._resources.enter_context(
-            patch('argparse._sys.stderr', self._stderr))
+        stderr_patcher = patch('argparse._sys.stderr', self._stderr)
+        stderr_patcher.start()
+        self.addCleanup(stderr_patcher.stop)
 
     def test_help(self):
         with self.assertRaises(SystemExit) as cm:
@@ -317,29 +317,30 @@ class TestMain(TestCase):
         # This tests needs to run the actual snap() helper function, not
         # the testsuite-wide mock.  This is appropriate since we're
         # mocking it ourselves here.
-        if NosePlugin.snap_mocker is not None:
-            NosePlugin.snap_mocker.patcher.stop()
-            self._resources.callback(NosePlugin.snap_mocker.patcher.start)
-        self._resources.enter_context(patch(
-            'ubuntu_image.helpers.subprocess_run',
-            return_value=SimpleNamespace(
-                returncode=1,
-                stdout='command stdout',
-                stderr='command stderr',
-                check_returncode=check_returncode,
-                )))
-        self._resources.enter_context(LogCapture())
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            XXXModelAssertionBuilder))
-        workdir = self._resources.enter_context(TemporaryDirectory())
-        imgfile = os.path.join(workdir, 'my-disk.img')
-        code = main(('--until', 'prepare_filesystems',
-                     '--channel', 'edge',
-                     '--workdir', workdir,
-                     '--output', imgfile,
-                     'model.assertion'))
-        self.assertEqual(code, 1)
+        with ExitStack() as resources:
+            if NosePlugin.snap_mocker is not None:
+                NosePlugin.snap_mocker.patcher.stop()
+                resources.callback(NosePlugin.snap_mocker.patcher.start)
+            resources.enter_context(patch(
+                'ubuntu_image.helpers.subprocess_run',
+                return_value=SimpleNamespace(
+                    returncode=1,
+                    stdout='command stdout',
+                    stderr='command stderr',
+                    check_returncode=check_returncode,
+                    )))
+            resources.enter_context(LogCapture())
+            resources.enter_context(patch(
+                'ubuntu_image.__main__.ModelAssertionBuilder',
+                XXXModelAssertionBuilder))
+            workdir = resources.enter_context(TemporaryDirectory())
+            imgfile = os.path.join(workdir, 'my-disk.img')
+            code = main(('--until', 'prepare_filesystems',
+                         '--channel', 'edge',
+                         '--workdir', workdir,
+                         '--output', imgfile,
+                         'model.assertion'))
+            self.assertEqual(code, 1)
 
     def test_no_arguments(self):
         with self.assertRaises(SystemExit) as cm:
@@ -379,6 +380,14 @@ class TestMain(TestCase):
 
 
 class TestMainWithGadget(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The test data doesn't move around, so only look it up once.
+        cls.model_assertion = resource_filename(
+            'ubuntu_image.tests.data', 'model.assertion')
+        cls.classic_gadget_tree = resource_filename(
+            'ubuntu_image.tests.data', 'gadget_tree')
+
     def setUp(self):
         super().setUp()
         self._resources = ExitStack()
@@ -394,10 +403,6 @@ class TestMainWithGadget(TestCase):
         # Set up a few other useful things for these tests.
         self._resources.enter_context(
             patch('ubuntu_image.__main__.logging.basicConfig'))
-        self.model_assertion = resource_filename(
-            'ubuntu_image.tests.data', 'model.assertion')
-        self.classic_gadget_tree = resource_filename(
-            'ubuntu_image.tests.data', 'gadget_tree')
 
     def test_output_without_subcommand(self):
         self._resources.enter_context(patch(
@@ -794,12 +799,15 @@ touch {}/success
 
 
 class TestMainWithBadGadget(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model_assertion = resource_filename(
+            'ubuntu_image.tests.data', 'model.assertion')
+
     def setUp(self):
         super().setUp()
         self._resources = ExitStack()
         self.addCleanup(self._resources.close)
-        self.model_assertion = resource_filename(
-            'ubuntu_image.tests.data', 'model.assertion')
 
     @skipIf('UBUNTU_IMAGE_TESTS_NO_NETWORK' in os.environ,
             'Cannot run this test without network access')